@@ -0,0 +1,104 @@
+# Applies the schema. Run once per deploy, before starting the server:
+#   python migrate.py
+import os
+import asyncio
+import asyncpg
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+if DATABASE_URL is None:
+    raise Exception("DATABASE_URL is not set in the environment.")
+
+
+async def create_friends_table(conn):
+    # nothing ever wrote to leaderboard; scores live on players
+    await conn.execute("DROP TABLE IF EXISTS leaderboard")
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS friends (
+            player_name TEXT NOT NULL,
+            friend_name TEXT NOT NULL,
+            PRIMARY KEY (player_name, friend_name)
+        )
+    ''')
+    # older tables had a SERIAL id key next to UNIQUE(player_name, friend_name)
+    await conn.execute('''
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_schema = current_schema() AND table_name = 'friends' AND column_name = 'id') THEN
+                ALTER TABLE friends DROP COLUMN id;
+                ALTER TABLE friends ADD PRIMARY KEY (player_name, friend_name);
+                ALTER TABLE friends DROP CONSTRAINT IF EXISTS friends_player_name_friend_name_key;
+            END IF;
+        END
+        $$
+    ''')
+
+
+async def create_friend_requests_table(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS friend_requests (
+            sender_name TEXT NOT NULL,
+            receiver_name TEXT NOT NULL,
+            PRIMARY KEY (sender_name, receiver_name)
+        )
+    ''')
+    # older tables had a SERIAL id key and could hold duplicate pending requests
+    await conn.execute('''
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_schema = current_schema() AND table_name = 'friend_requests' AND column_name = 'id') THEN
+                DELETE FROM friend_requests a
+                USING friend_requests b
+                WHERE a.sender_name = b.sender_name AND a.receiver_name = b.receiver_name AND a.id > b.id;
+                ALTER TABLE friend_requests DROP COLUMN id;
+                ALTER TABLE friend_requests ADD PRIMARY KEY (sender_name, receiver_name);
+            END IF;
+        END
+        $$
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_friend_requests_receiver ON friend_requests (receiver_name)")
+
+
+async def create_players_table(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS players (
+            id UUID PRIMARY KEY,
+            name TEXT,
+            token TEXT UNIQUE NOT NULL,
+            score INTEGER DEFAULT 0,
+            sps INTEGER DEFAULT 0,
+            last_updated TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    # tables created before last_updated became TIMESTAMPTZ stored naive UTC times
+    await conn.execute('''
+        DO $$
+        BEGIN
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'players' AND column_name = 'last_updated'
+            ) = 'timestamp without time zone' THEN
+                ALTER TABLE players ALTER COLUMN last_updated TYPE TIMESTAMPTZ USING last_updated AT TIME ZONE 'UTC';
+            END IF;
+        END
+        $$
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_players_score_name ON players (score DESC) INCLUDE (name)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_players_name_score ON players (name) INCLUDE (score)")
+
+
+async def migrate():
+    conn = await asyncpg.connect(dsn=DATABASE_URL)
+    try:
+        async with conn.transaction():
+            # serializes concurrent runs; the lock is released on commit
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('spankmedaddy_schema'))")
+            await create_friends_table(conn)
+            await create_friend_requests_table(conn)
+            await create_players_table(conn)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -1,15 +1,20 @@
 import os
-from fastapi import FastAPI, HTTPException, Header, Request, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Header, Request, Depends, Query
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import List, Dict
-from datetime import datetime, timezone
+import asyncpg
+from cachetools import TTLCache
+from typing import List, Dict, Optional
+import asyncio
+import logging
+import orjson
+import secrets
 import uuid
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+logger = logging.getLogger(__name__)
 
 RESET_API_KEY = os.getenv("RESET_API_KEY")
 if RESET_API_KEY is None:
@@ -21,223 +26,280 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Offset"],
+    max_age=86400,
 )
+app.add_middleware(GZipMiddleware, minimum_size=200, compresslevel=4)
 
 
-def get_db_connection():
-    DATABASE_URL = os.getenv("DATABASE_URL")
-    if DATABASE_URL is None:
-        raise Exception("DATABASE_URL is not set in the environment.")
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return conn
+DATABASE_URL = os.getenv("DATABASE_URL")
+if DATABASE_URL is None:
+    raise Exception("DATABASE_URL is not set in the environment.")
 
+# serialized top-10, shared by every /leaderboard hit within the TTL
+LEADERBOARD_CACHE = TTLCache(maxsize=1, ttl=2)
+leaderboard_lock = asyncio.Lock()
 
-def create_table():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS leaderboard (
-            id SERIAL PRIMARY KEY,
-            name TEXT NOT NULL,
-            score INTEGER NOT NULL
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS friends (
-            id SERIAL PRIMARY KEY,
-            player_name TEXT NOT NULL,
-            friend_name TEXT NOT NULL,
-            UNIQUE(player_name, friend_name)
-        )
-    ''')
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-
-def create_friend_requests_table():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS friend_requests (
-            id SERIAL PRIMARY KEY,
-            sender_name TEXT NOT NULL,
-            receiver_name TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-
-def create_players_table():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS players (
-            id UUID PRIMARY KEY,
-            name TEXT,
-            token TEXT UNIQUE NOT NULL,
-            score INTEGER DEFAULT 0,
-            sps INTEGER DEFAULT 0,
-            last_updated TIMESTAMP DEFAULT NOW()
-        )
-    ''')
-    conn.commit()
-    cursor.close()
-    conn.close()
+# token -> (id, name, token); only columns that never change, never score state.
+# The TTL bounds how long another worker keeps honouring a deleted token.
+PLAYER_CACHE = TTLCache(maxsize=10_000, ttl=30)
+# tokens that just failed lookup, so repeated bad polls don't each reach Postgres
+UNKNOWN_TOKENS = TTLCache(maxsize=10_000, ttl=5)
+
+MAX_CLICKS_PER_PACK = 200
+MAX_CLICKS_PER_SECOND = 15
+
+
+def auto_spank_price(sps):
+    price = (10 * 5.5) ** (sps + 1)
+    if sps != 0:
+        price = price / (10 * sps)
+    return price
 
 
-create_table()
-create_friend_requests_table()
-create_players_table()
+# score is an INTEGER column, so past the first few levels no price is ever affordable;
+# 16 levels already reaches prices far beyond 2**31
+AUTO_SPANK_PRICES = [auto_spank_price(sps) for sps in range(16)]
+
+
+def on_leaderboard_changed(connection, pid, channel, payload):
+    LEADERBOARD_CACHE.pop("top10", None)
+
+
+def on_token_invalidated(connection, pid, channel, payload):
+    # an empty payload means every player was removed
+    if payload:
+        PLAYER_CACHE.pop(payload, None)
+    else:
+        PLAYER_CACHE.clear()
+
+
+async def open_listener():
+    connection = await asyncpg.connect(dsn=DATABASE_URL)
+    try:
+        await connection.add_listener("leaderboard_changed", on_leaderboard_changed)
+        await connection.add_listener("token_invalidated", on_token_invalidated)
+    except BaseException:
+        # not app.state.listener yet, so closing it won't trigger on_listener_lost
+        await connection.close()
+        raise
+    connection.add_termination_listener(on_listener_lost)
+    app.state.listener = connection
+
+
+def on_listener_lost(connection):
+    # shutdown detaches the listener before closing it
+    if connection is not app.state.listener:
+        return
+    logger.warning("LISTEN connection lost, reconnecting")
+    # until we're listening again, removals on other workers go unseen, so
+    # stop serving and refilling the player cache
+    app.state.listener = None
+    PLAYER_CACHE.clear()
+    app.state.reconnect = asyncio.get_running_loop().create_task(reconnect_listener())
+    app.state.reconnect.add_done_callback(on_reconnect_done)
+
+
+def on_reconnect_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        # nothing retries after this, so the player cache stays off for this worker
+        logger.error("LISTEN reconnect gave up, player cache disabled", exc_info=task.exception())
+
+
+async def reconnect_listener():
+    delay = 1
+    while True:
+        try:
+            await open_listener()
+        except (OSError, asyncpg.PostgresError) as error:
+            logger.warning("LISTEN reconnect failed (%s), retrying in %ss", error, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+        else:
+            break
+    # anything NOTIFYed while we were away was missed
+    LEADERBOARD_CACHE.pop("top10", None)
+    PLAYER_CACHE.clear()
+    logger.warning("LISTEN connection restored")
+
+
+@app.on_event("startup")
+async def open_pool():
+    app.state.pool = await asyncpg.create_pool(dsn=DATABASE_URL, min_size=5, max_size=20)
+    # score/sps writes only: their commits return before the WAL flush, so a crash can
+    # lose the last fraction of a second of game progress. registrations, deletes and
+    # friend changes stay on the durable pool above
+    app.state.score_pool = await asyncpg.create_pool(
+        dsn=DATABASE_URL,
+        min_size=2,
+        max_size=10,
+        server_settings={"synchronous_commit": "off"},
+    )
+
+    # other workers NOTIFY here when they remove players, so every worker drops its
+    # cached top 10 and stops honouring the removed tokens
+    app.state.reconnect = None
+    await open_listener()
+
+
+@app.on_event("shutdown")
+async def close_pool():
+    if app.state.reconnect is not None:
+        app.state.reconnect.cancel()
+    listener, app.state.listener = app.state.listener, None
+    if listener is not None:
+        await listener.close()
+    await app.state.score_pool.close()
+    await app.state.pool.close()
 
 
 class RegisterRequest(BaseModel):
     name: str
 
+class PlayerAction(BaseModel):
+    type: str
+    data: Optional[Dict] = None
+
 class PlayerActionsSecure(BaseModel):
-    actions: List[Dict]
+    actions: List[PlayerAction]
 
 class PlayerTokenSecure(BaseModel):
     token: str
 
-@app.post("/register", response_model=PlayerTokenSecure)
-def register_player(payload: RegisterRequest):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+class AddFriendRequest(BaseModel):
+    player_name: str
+    friend_name: str
 
+class RespondFriendRequest(BaseModel):
+    sender: str
+    receiver: str
+    accept: bool
+
+@app.post("/register", response_model=PlayerTokenSecure)
+async def register_player(payload: RegisterRequest):
     player_id = str(uuid.uuid4())
-    token = str(uuid.uuid4())
+    token = secrets.token_urlsafe(16)
 
-    cursor.execute("INSERT INTO players (id, name, token) VALUES (%s, %s, %s)",
-                   (player_id, payload.name, token))
-    conn.commit()
-    cursor.close()
-    conn.close()
+    async with app.state.pool.acquire() as conn:
+        await conn.execute("INSERT INTO players (id, name, token) VALUES ($1, $2, $3)",
+                           player_id, payload.name, token)
 
     return PlayerTokenSecure(token=token)
 
-def get_authenticated_player(request: Request):
+async def find_player(token):
+    player = PLAYER_CACHE.get(token)
+    if player is None and token not in UNKNOWN_TOKENS:
+        async with app.state.pool.acquire() as conn:
+            player = await conn.fetchrow("SELECT id, name, token FROM players WHERE token = $1", token)
+        if player:
+            # without the listener nothing would evict this entry if the player is deleted
+            if app.state.listener is not None:
+                PLAYER_CACHE[token] = player
+        else:
+            UNKNOWN_TOKENS[token] = True
+    return player
+
+async def get_authenticated_player(request: Request):
     token = request.headers.get("Authorization")
     if not token or not token.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid token")
 
     token = token.split(" ")[1]
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM players WHERE token = %s", (token,))
-    player = cursor.fetchone()
-    cursor.close()
-    conn.close()
-
+    player = await find_player(token)
     if not player:
         raise HTTPException(status_code=401, detail="Invalid token")
     return player
 
 @app.post("/game/actions")
-def receive_actions(payload: PlayerActionsSecure, player=Depends(get_authenticated_player)):
-    now = datetime.now(timezone.utc)
-    last_updated = player["last_updated"]
-    if last_updated.tzinfo is None:
-        last_updated = last_updated.replace(tzinfo=timezone.utc)
-
-    sps = player["sps"]
-
-    seconds_passed = (now - last_updated).total_seconds()
-    passive_earned = int(sps * seconds_passed)
-
-    click_count = sum(1 for a in payload.actions if a.get("type") == "click")
+async def receive_actions(payload: PlayerActionsSecure, player=Depends(get_authenticated_player)):
+    click_count = 0
+    auto_spanks = 0
+    for action in payload.actions:
+        if action.type == "click":
+            click_count += 1
+        elif action.type == "buy_upgrade" and action.data and action.data.get("upgrade") == "auto_spank":
+            auto_spanks += 1
 
-    MAX_CLICKS_PER_PACK = 200
     if click_count > MAX_CLICKS_PER_PACK:
         raise HTTPException(status_code=400, detail="Too many clicks in short time")
 
-    max_clicks = int(seconds_passed * 15)
-    if max_clicks < 1:
-        max_clicks = 1
-
-    if click_count > max_clicks:
-        raise HTTPException(status_code=400, detail="Too many clicks in short time")
-
-    score = player["score"] + passive_earned + click_count
-    for action in payload.actions:
-        if action["type"] == "buy_upgrade":
-            upgrade = action["data"].get("upgrade")
-            if upgrade == "auto_spank":
-                price = (10 * 5.5) ** (sps + 1)
-                if sps != 0:
-                    price = price / (10 * sps)
+    if not auto_spanks:
+        # nothing to price, so passive income, the click rate check and the
+        # write all happen in one statement against the stored last_updated
+        async with app.state.score_pool.acquire() as conn:
+            row = await conn.fetchrow('''
+                UPDATE players
+                SET score = score + FLOOR(sps * EXTRACT(EPOCH FROM NOW() - last_updated))::int + $2,
+                    last_updated = NOW()
+                WHERE id = $1
+                  AND $2 <= GREATEST(1, FLOOR(EXTRACT(EPOCH FROM NOW() - last_updated) * $3::int))
+                  AND ($2 > 0 OR FLOOR(sps * EXTRACT(EPOCH FROM NOW() - last_updated)) >= 1)
+                RETURNING score
+            ''', player["id"], click_count, MAX_CLICKS_PER_SECOND)
+        if row is None and click_count:
+            raise HTTPException(status_code=400, detail="Too many clicks in short time")
+        # an empty pack that hasn't earned a whole spank yet leaves the row untouched
+        return {"message": f"Actions processed"}
+
+    async with app.state.score_pool.acquire() as conn:
+        async with conn.transaction():
+            # the row lock keeps a concurrent pack from spending the same spanks
+            state = await conn.fetchrow('''
+                SELECT score, sps, EXTRACT(EPOCH FROM NOW() - last_updated)::float8 AS seconds_passed
+                FROM players WHERE id = $1 FOR UPDATE
+            ''', player["id"])
+            if not state:
+                raise HTTPException(status_code=401, detail="Invalid token")
+
+            sps = state["sps"]
+
+            seconds_passed = state["seconds_passed"]
+            passive_earned = int(sps * seconds_passed)
+
+            max_clicks = int(seconds_passed * MAX_CLICKS_PER_SECOND)
+            if max_clicks < 1:
+                max_clicks = 1
+
+            if click_count > max_clicks:
+                raise HTTPException(status_code=400, detail="Too many clicks in short time")
+
+            score = state["score"] + passive_earned + click_count
+            for _ in range(auto_spanks):
+                price = AUTO_SPANK_PRICES[sps] if sps < len(AUTO_SPANK_PRICES) else auto_spank_price(sps)
                 if score >= price:
                     score -= price
                     sps += 1
                 else:
                     raise HTTPException(status_code=400, detail="Not enough spanks")
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE players SET score = %s, sps = %s, last_updated = %s WHERE id = %s",
-        (score, sps, now, player["id"])
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+            # NOW() is fixed for the transaction, so this matches the instant seconds_passed ended at
+            await conn.execute(
+                "UPDATE players SET score = $1, sps = $2, last_updated = NOW() WHERE id = $3",
+                round(score), sps, player["id"]
+            )
 
     return {"message": f"Actions processed"}
 
 @app.post("/game/updatesps")
-def updatesps(payload: PlayerActionsSecure):
-    token = payload.token
-    if not token or not token.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid token")
-
-    token = token.split(" ")[1]
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM players WHERE token = %s", (token,))
-    player = cursor.fetchone()
-    cursor.close()
-    conn.close()
-
-    if not player:
+async def updatesps(player=Depends(get_authenticated_player)):
+    async with app.state.score_pool.acquire() as conn:
+        row = await conn.fetchrow('''
+            UPDATE players
+            SET score = score + FLOOR(sps * EXTRACT(EPOCH FROM NOW() - last_updated))::int,
+                last_updated = NOW()
+            WHERE id = $1
+            RETURNING score
+        ''', player["id"])
+    if row is None:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-
-    now = datetime.now(timezone.utc)
-    last_updated = player["last_updated"]
-    if last_updated.tzinfo is None:
-        last_updated = last_updated.replace(tzinfo=timezone.utc)
-
-    sps = player["sps"]
-
-    seconds_passed = (now - last_updated).total_seconds()
-    passive_earned = int(sps * seconds_passed)
-
-    score = player["score"] + passive_earned
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE players SET score = %s, sps = %s, last_updated = %s WHERE id = %s",
-        (score, sps, now, player["id"])
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
-
     return {"message": f"Actions processed"}
 
 
 @app.get("/player_data")
-def get_player_data(player=Depends(get_authenticated_player)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT score, sps FROM players WHERE token = %s", (player["token"],))
-    row = cursor.fetchone()
-    cursor.close()
-    conn.close()
+async def get_player_data(player=Depends(get_authenticated_player)):
+    async with app.state.pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT score, sps FROM players WHERE id = $1", player["id"])
 
     if row:
         return {"score": row["score"], "sps": row["sps"]}
@@ -245,127 +307,152 @@ def get_player_data(player=Depends(get_authenticated_player)):
         return {"score": 0, "sps": 0}
 
 @app.post("/delete_player/{player_token}")
-def delete_player(player_token: str, x_api_key: str = Header(None)):
+async def delete_player(player_token: str, x_api_key: str = Header(None)):
     if x_api_key != RESET_API_KEY:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("DELETE FROM players WHERE token = %s", (player_token,))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        async with app.state.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM players WHERE token = $1", player_token)
+                await conn.execute("NOTIFY leaderboard_changed")
+                await conn.execute("SELECT pg_notify('token_invalidated', $1)", player_token)
+        LEADERBOARD_CACHE.pop("top10", None)
+        PLAYER_CACHE.pop(player_token, None)
         return {"message": "player deleted"}
     return {"message": "key isn't valid!"}
 
 @app.post("/reset_all_players")
-def delete_player(x_api_key: str = Header(None)):
+async def delete_player(x_api_key: str = Header(None)):
     if x_api_key != RESET_API_KEY:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM players")
-        conn.commit()
-        cursor.close()
-        conn.close()
+        async with app.state.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM players")
+                await conn.execute("NOTIFY leaderboard_changed")
+                await conn.execute("NOTIFY token_invalidated")
+        LEADERBOARD_CACHE.pop("top10", None)
+        PLAYER_CACHE.clear()
         return {"message": "players reset"}
     return {"message": "key isn't valid!"}
 
 
 @app.get("/token_valid")
-def token_valid(request: Request):
+async def token_valid(request: Request):
     token = request.headers.get("Authorization")
     if not token or not token.startswith("Bearer "):
-        return JSONResponse(content={"valid": False})
+        return {"valid": False}
 
     token = token.split(" ")[1]
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM players WHERE token = %s", (token,))
-    player = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    player = await find_player(token)
 
-    return JSONResponse(content={"valid": bool(player)})
+    return {"valid": bool(player)}
 
 @app.get("/leaderboard")
-def get_leaderboard():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, score FROM players ORDER BY score DESC LIMIT 10")
-    leaderboard = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return leaderboard
+async def get_leaderboard():
+    body = LEADERBOARD_CACHE.get("top10")
+    if body is None:
+        async with leaderboard_lock:
+            body = LEADERBOARD_CACHE.get("top10")
+            if body is None:
+                async with app.state.pool.acquire() as conn:
+                    leaderboard = await conn.fetch("SELECT name, score FROM players ORDER BY score DESC LIMIT 10")
+                body = orjson.dumps([{"name": name, "score": score} for name, score in leaderboard])
+                LEADERBOARD_CACHE["top10"] = body
+    return Response(content=body, media_type="application/json")
 
 
 @app.post("/add_friend")
-def add_friend(data: dict):
-    player = data["player_name"]
-    friend = data["friend_name"]
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM players WHERE name = %s", (friend,))
-    if not cursor.fetchone():
-        conn.close()
-        return {"message": "That player doesn't exist!"}
-
-    cursor.execute("SELECT * FROM friends WHERE player_name = %s AND friend_name = %s", (player, friend))
-    if cursor.fetchone():
-        conn.close()
-        return {"message": "Already friends!"}
-
-    cursor.execute("SELECT * FROM friend_requests WHERE sender_name = %s AND receiver_name = %s", (player, friend))
-    if cursor.fetchone():
-        conn.close()
-        return {"message": "Friend request already sent!"}
-
-    cursor.execute("INSERT INTO friend_requests (sender_name, receiver_name) VALUES (%s, %s)", (player, friend))
-    conn.commit()
-    conn.close()
+async def add_friend(payload: AddFriendRequest):
+    player = payload.player_name
+    friend = payload.friend_name
+
+    async with app.state.pool.acquire() as conn:
+        checks = await conn.fetchrow('''
+            SELECT
+                EXISTS(SELECT 1 FROM players WHERE name = $2) AS friend_exists,
+                EXISTS(SELECT 1 FROM friends WHERE player_name = $1 AND friend_name = $2) AS already_friends
+        ''', player, friend)
+
+        if not checks["friend_exists"]:
+            return {"message": "That player doesn't exist!"}
+
+        if checks["already_friends"]:
+            return {"message": "Already friends!"}
+
+        inserted = await conn.fetchval('''
+            INSERT INTO friend_requests (sender_name, receiver_name) VALUES ($1, $2)
+            ON CONFLICT (sender_name, receiver_name) DO NOTHING
+            RETURNING 1
+        ''', player, friend)
+        if not inserted:
+            return {"message": "Friend request already sent!"}
     return {"message": f"Friend request sent to {friend}!"}
 
 
+def set_next_offset(response, fetched, limit, offset):
+    # pages fetch one extra row; when it shows up, tell the client where the next page starts
+    if fetched > limit:
+        response.headers["X-Next-Offset"] = str(offset + limit)
+
+
 @app.get("/friends/{player_name}")
-def get_friends(player_name: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT players.name, players.score
-        FROM friends
-        JOIN players ON friends.friend_name = players.name
-        WHERE friends.player_name = %s
-    """, (player_name,))
-    friends = cursor.fetchall()
-    conn.close()
-    return friends
+async def get_friends(response: Response, player_name: str, limit: int = Query(100, ge=1, le=500), offset: int = Query(0, ge=0)):
+    async with app.state.pool.acquire() as conn:
+        # names aren't unique, so players.id breaks ties between same-named rows
+        friends = await conn.fetch("""
+            SELECT players.name, players.score
+            FROM friends
+            JOIN players ON friends.friend_name = players.name
+            WHERE friends.player_name = $1
+            ORDER BY friends.friend_name, players.id
+            LIMIT $2 OFFSET $3
+        """, player_name, limit + 1, offset)
+    set_next_offset(response, len(friends), limit, offset)
+    return [{"name": name, "score": score} for name, score in friends[:limit]]
 
 
 @app.get("/get_friend_requests")
-def get_friend_requests(username: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT sender_name FROM friend_requests WHERE receiver_name = %s", (username,))
-    requests = [row["sender_name"] for row in cursor.fetchall()]
-    cursor.close()
-    conn.close()
+async def get_friend_requests(response: Response, username: str, limit: int = Query(100, ge=1, le=500), offset: int = Query(0, ge=0)):
+    async with app.state.pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT sender_name FROM friend_requests WHERE receiver_name = $1 ORDER BY sender_name LIMIT $2 OFFSET $3",
+            username, limit + 1, offset
+        )
+    set_next_offset(response, len(rows), limit, offset)
+    requests = [row[0] for row in rows[:limit]]
     return requests
 
 
 @app.post("/respond_friend_request")
-def respond_friend_request(data: dict):
-    sender = data["sender"]
-    receiver = data["receiver"]
-    accept = data["accept"]
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM friend_requests WHERE sender_name = %s AND receiver_name = %s", (sender, receiver))
-
-    if accept:
-        cursor.execute("INSERT INTO friends (player_name, friend_name) VALUES (%s, %s)", (receiver, sender))
-        cursor.execute("INSERT INTO friends (player_name, friend_name) VALUES (%s, %s)", (sender, receiver))
-
-    conn.commit()
-    cursor.close()
-    conn.close()
+async def respond_friend_request(payload: RespondFriendRequest):
+    sender = payload.sender
+    receiver = payload.receiver
+    accept = payload.accept
+
+    async with app.state.pool.acquire() as conn:
+        if accept:
+            await conn.execute('''
+                WITH deleted AS (
+                    DELETE FROM friend_requests
+                    WHERE sender_name = $1 AND receiver_name = $2
+                    RETURNING sender_name, receiver_name
+                )
+                INSERT INTO friends (player_name, friend_name)
+                SELECT receiver_name, sender_name FROM deleted
+                UNION ALL
+                SELECT sender_name, receiver_name FROM deleted
+                ON CONFLICT (player_name, friend_name) DO NOTHING
+            ''', sender, receiver)
+        else:
+            await conn.execute("DELETE FROM friend_requests WHERE sender_name = $1 AND receiver_name = $2", sender, receiver)
     return {"message": "Friend request responded to!"}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # clients poll /token_valid and /player_data back to back, so keep their connections open between polls
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        http="httptools",
+        timeout_keep_alive=30,
+    )